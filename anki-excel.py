@@ -1,21 +1,45 @@
-import codecs
 import pandas as pd
 import argparse
+import csv
 from pathlib import Path
-from typing import List, Sequence
+from itertools import chain
+from typing import Iterator, List
 from common import utils, Card
 
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ModuleNotFoundError:
+    pa = None
+except ImportError as e:
+    # Installed but unusable, e.g. a pyarrow build that needs a newer NumPy than requirements.txt allows.
+    print(f"warning: pyarrow can't be loaded, reading CSV files with pandas and Parquet files won't work: {str(e)}")
+    pa = None
+
+CSV_CHUNK_SIZE = 50_000
+CSV_BLOCK_SIZE = 1 << 22
+OUTPUT_BUFFER_SIZE = 1 << 20
+
 
 def _parse_cmdline_args():
     format_description = '''
-Source Excel/CSV file columns
------------------------------
+Source Excel/CSV/Parquet file columns
+-------------------------------------
 
 - Word: Hebrew word (nekudot will be stripped unless a dot flag is specified, see below)
 - Translation
 - Pronunciation: use stars to indicate stress (e.g. peal*i*m)
 - Flags: see below
 - Tags: add to each card produced from this line
+
+Excel files are much slower to read than CSV or Parquet; for large word lists,
+export the sheet to CSV first.
     ''' + utils.flags_help_text()
 
     parser = argparse.ArgumentParser(epilog=format_description, formatter_class=argparse.RawTextHelpFormatter)
@@ -28,47 +52,84 @@ Source Excel/CSV file columns
     return parser.parse_args()
 
 
-def read_source_file(path: Path, additional_tags: str) -> Sequence[Card]:
-    cards: List[Card] = list()
-
-    if path.suffix.lower() == '.csv':
-        df = pd.read_csv(str(path))
-    elif path.suffix.lower() in ['.xlsx', '.xls']:
-        df = pd.read_excel(str(path))
-    else:
-        print(f"{str(path)}: unsupported extension")
-        return cards
+def _read_csv_header(path: Path) -> List[str]:
+    with open(path, 'r', encoding='utf_8_sig', newline='') as fh:
+        return next(csv.reader(fh), list())
 
-    core_columns = ['Word', 'Translation', 'Pronunciation']
-    core_columns_count = len([c for c in df.columns if c in core_columns])
-    if core_columns_count < 2:
-        print(f"{str(path)}: at least two columns must be present: {','.join(core_columns)}")
-        return cards
 
-    def _field_to_str(row: pd.Series, col: str) -> str:
-        if col in row.index:
-            return str(row[col])
-        else:
-            return ''
+def _iter_csv_batches(path: Path) -> Iterator[pd.DataFrame]:
+    # read_csv(engine='pyarrow') doesn't support chunksize, so the file is streamed block by block instead.
+    # All columns are read as non-null strings, to match dtype=str, na_filter=False of the other readers,
+    # and quoted values may span lines, as they can with pandas.
+    column_types = {name: pa.string() for name in _read_csv_header(path)}
+    reader = pa_csv.open_csv(str(path),
+                             read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                             parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                             convert_options=pa_csv.ConvertOptions(column_types=column_types))
+    for batch in reader:
+        yield batch.to_pandas()
 
-    for i in range(df.index.size):
-        r = df.iloc[i]
-        cards.append(Card(word=_field_to_str(r, 'Word'),
-                          translation=_field_to_str(r, 'Translation'),
-                          pronunciation=_field_to_str(r, 'Pronunciation'),
-                          flags=_field_to_str(r, 'Flags'),
-                          tags=_field_to_str(r, 'Tags') + ' ' + additional_tags,
-                          source=f"{path.name}"
-                          ))
 
-    return cards
+def _iter_csv_chunks(path: Path, skip_rows: int = 0) -> Iterator[pd.DataFrame]:
+    for df in pd.read_csv(str(path), chunksize=CSV_CHUNK_SIZE, dtype=str, keep_default_na=False, na_filter=False):
+        if skip_rows >= df.index.size:
+            skip_rows -= df.index.size
+            continue
+        yield df.iloc[skip_rows:]
+        skip_rows = 0
 
 
-def field_to_str(val) -> str:
-    if pd.isna(val):
-        return ''
+def _iter_source_frames(path: Path) -> Iterator[pd.DataFrame]:
+    if path.suffix.lower() == '.csv':
+        if pa is not None:
+            n_rows = 0
+            try:
+                for df in _iter_csv_batches(path):
+                    n_rows += df.index.size
+                    yield df
+                return
+            except pa.ArrowInvalid as e:
+                # pyarrow rejects rows with fewer fields than the header, pandas fills them with empty strings.
+                print(f"{str(path)}: {str(e)}, reading the rest with pandas")
+            yield from _iter_csv_chunks(path, skip_rows=n_rows)
+        else:
+            yield from _iter_csv_chunks(path)
+    elif path.suffix.lower() == '.parquet':
+        yield pd.read_parquet(str(path))
+    elif path.suffix.lower() in ['.xlsx', '.xls']:
+        # Excel files can't be read in chunks.
+        yield pd.read_excel(str(path), engine=EXCEL_ENGINE, dtype=str, keep_default_na=False, na_filter=False)
     else:
-        return str(val).strip()
+        print(f"{str(path)}: unsupported extension")
+
+
+def iter_source_file(path: Path, additional_tags: str) -> Iterator[Card]:
+    for df in _iter_source_frames(path):
+        core_columns = ['Word', 'Translation', 'Pronunciation']
+        core_columns_count = len([c for c in df.columns if c in core_columns])
+        if core_columns_count < 2:
+            print(f"{str(path)}: at least two columns must be present: {','.join(core_columns)}")
+            return
+
+        def _column_to_list(col: str) -> List[str]:
+            if col in df.columns:
+                # CSV and Excel columns are already NaN-free strings; this is for typed Parquet columns.
+                return df[col].fillna('').astype(str).tolist()
+            else:
+                return [''] * df.index.size
+
+        for word, translation, pronunciation, flags, tags in zip(_column_to_list('Word'),
+                                                                 _column_to_list('Translation'),
+                                                                 _column_to_list('Pronunciation'),
+                                                                 _column_to_list('Flags'),
+                                                                 _column_to_list('Tags')):
+            yield Card(word=word,
+                       translation=translation,
+                       pronunciation=pronunciation,
+                       flags=flags,
+                       tags=tags + ' ' + additional_tags,
+                       source=f"{path.name}"
+                       )
 
 
 def main():
@@ -79,15 +140,15 @@ def main():
         additional_tags = utils.cleanup(args.tags)
 
     print(f"reading file {str(args.in_file)}")
-    all_cards = read_source_file(args.in_file, additional_tags)
-    print(f"{len(all_cards)} total cards loaded")
+    cards = iter_source_file(args.in_file, additional_tags)
+    first_card = next(cards, None)
 
-    if len(all_cards) > 0:
+    if first_card is not None:
         print(f"writing cards to {str(args.out_file)}")
-        with codecs.open(args.out_file, 'w', encoding='utf_8') as fh_out:
+        with open(args.out_file, 'w', encoding='utf_8', newline='', buffering=OUTPUT_BUFFER_SIZE) as fh_out:
             Card.save_header(fh_out)
-            for card in all_cards:
-                card.save(fh_out)
+            n_cards = Card.save_many(chain([first_card], cards), fh_out)
+        print(f"{n_cards} total cards loaded")
     else:
         print('No cards loaded, nothing to write!')
 
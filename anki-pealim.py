@@ -1,15 +1,39 @@
-from requests import Session, RequestException
+from requests import Request, Session, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, Future
 from copy import copy
+from datetime import timedelta
+from functools import lru_cache
+from itertools import chain
 import argparse
 import codecs
+import html
 from pathlib import Path
-from bs4 import BeautifulSoup, PageElement
-from typing import Callable, List, Dict, Tuple, Optional
+from bs4 import BeautifulSoup, PageElement, SoupStrainer, Tag
+from typing import Callable, Iterable, List, Dict, Optional, Sequence, Tuple
 import re
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlsplit
 from random import randint
 from common import utils, Card
 
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+try:
+    from requests_cache import CachedSession
+except ImportError:
+    CachedSession = None
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+REQUEST_TIMEOUT = 30
+CACHE_EXPIRE_AFTER = timedelta(days=30)
+
 
 def parse_flags(s: str) -> List[str]:
     result: List[str] = list()
@@ -20,6 +44,13 @@ def parse_flags(s: str) -> List[str]:
     return result
 
 
+def positive_int(s: str) -> int:
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expected a number of at least 1, got {s}")
+    return value
+
+
 def parse_cmdline_args():
     format_description = '''
 Source file format
@@ -48,27 +79,54 @@ Inclusion has priority.
     parser.add_argument('-x', '--exclude', dest='exclude_flags', metavar='FLAGS',
                         default=list(), type=parse_flags,
                         help="exclude cards with the specified flags (comma-separated list)")
+    parser.add_argument('-w', '--workers', dest='workers', metavar='N', default=4, type=positive_int,
+                        help="number of URLs to read in parallel (default: 4)")
+    parser.add_argument('-c', '--cache', dest='cache', metavar='FILE', default='pealim_cache.sqlite', type=str,
+                        help="keep downloaded pages in this SQLite file for 30 days, if requests-cache is installed " +
+                             "(default: pealim_cache.sqlite)")
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const=None,
+                        help="always download pages")
     return parser.parse_args()
 
 
-Handler = Callable[[BeautifulSoup, str], List[Card]]
+Handler = Callable[..., List[Card]]
 
 
-def handle_id_list(soup: BeautifulSoup, url: str, ids: Dict[str, str]) -> List[Card]:
+# get_text() decodes entities, so the text is escaped again for the #html:true deck.
+def element_text(e: Optional[PageElement]) -> str:
+    return html.escape(e.get_text().strip(), quote=False) if e is not None else ''
+
+
+# Transcriptions mark the stressed syllable with <b>, so they keep their markup.
+def element_html(e: Optional[PageElement]) -> str:
+    return str(e).strip() if e is not None else ''
+
+
+def handle_id_list(soup: BeautifulSoup, url: str, ids: Dict[str, str], *, extra_tags: str = '',
+                   include_flags: Sequence[str] = (), exclude_flags: Sequence[str] = ()) -> List[Card]:
     cards: List[Card] = list()
     entries_not_found: List[str] = list()
+    # Index the elements by ID in a single walk rather than searching the tree once per ID.
+    # setdefault() keeps the first match for each ID, same as soup.find(id=...).
+    id_map: Dict[str, Tag] = dict()
+    for tag in soup.find_all(True, id=True):
+        id_map.setdefault(tag['id'], tag)
+    include_masks = Card.precompile_filter(include_flags)
+    exclude_masks = Card.precompile_filter(exclude_flags)
     for i, flags in ids.items():
-        e_root = soup.find(id=i)
+        if not Card.flags_pass(flags, include_masks, exclude_masks):
+            continue
+        e_root = id_map.get(i)
         if e_root is not None:
             e_word = e_root.find('span', attrs={"class": "menukad"})
             e_translation = e_root.find(attrs={"class": "meaning"})
             e_pronunciation = e_root.find(attrs={"class": "transcription"})
             n_found_elements = len([e for e in [e_word, e_translation, e_pronunciation] if e is not None])
             if n_found_elements > 1:
-                cards.append(Card(word=str(e_word).strip() if e_word is not None else '',
-                                  translation=str(e_translation).strip() if e_translation is not None else '',
-                                  pronunciation=str(e_pronunciation).strip() if e_pronunciation is not None else '',
-                                  source=url, flags=flags))
+                cards.append(Card(word=element_text(e_word),
+                                  translation=element_text(e_translation),
+                                  pronunciation=element_html(e_pronunciation),
+                                  source=url, flags=flags, tags=extra_tags))
                 continue
         entries_not_found.append(flags)
     if len(entries_not_found) > 0:
@@ -76,37 +134,55 @@ def handle_id_list(soup: BeautifulSoup, url: str, ids: Dict[str, str]) -> List[C
     return cards
 
 
-def handle_verb(soup: BeautifulSoup, url: str) -> List[Card]:
-    return handle_id_list(soup, url, ids={
-        'INF-L': 'VI',
-        'AP-ms': 'VPms', 'AP-fs': 'VPfs', 'AP-mp': 'VPms', 'AP-fp': 'VPfs',
-        'PERF-1s': 'VS1s', 'PERF-1p': 'VS1p',
-        'PERF-2ms': 'VS2ms', 'PERF-2fs': 'VS2fs', 'PERF-2mp': 'VS2mp', 'PERF-2fp': 'VS2fp',
-        'PERF-3ms': 'VS3ms', 'PERF-3fs': 'VS3ms', 'PERF-3p': 'VS3p',
-        'IMPF-1s': 'VF1s', 'IMPF-1p': 'VF1p',
-        'IMPF-2ms': 'VF2ms', 'IMPF-2fs': 'VF2fs', 'IMPF-2mp': 'VF2mp', 'IMPF-2fp': 'VF2fp',
-        'IMPF-3ms': 'VF3ms', 'IMPF-3fs': 'VF3fs', 'IMPF-3mp': 'VF3mp', 'IMPF-3fp': 'VF3fp',
-        'IMP-2ms': 'V!ms', 'IMP-2fs': 'V!fs', 'IMP-2mp': 'V!mp', 'IMP-2fp': 'V!fp'
-    })
+verb_ids: Dict[str, str] = {
+    'INF-L': 'VI',
+    'AP-ms': 'VPms', 'AP-fs': 'VPfs', 'AP-mp': 'VPms', 'AP-fp': 'VPfs',
+    'PERF-1s': 'VS1s', 'PERF-1p': 'VS1p',
+    'PERF-2ms': 'VS2ms', 'PERF-2fs': 'VS2fs', 'PERF-2mp': 'VS2mp', 'PERF-2fp': 'VS2fp',
+    'PERF-3ms': 'VS3ms', 'PERF-3fs': 'VS3ms', 'PERF-3p': 'VS3p',
+    'IMPF-1s': 'VF1s', 'IMPF-1p': 'VF1p',
+    'IMPF-2ms': 'VF2ms', 'IMPF-2fs': 'VF2fs', 'IMPF-2mp': 'VF2mp', 'IMPF-2fp': 'VF2fp',
+    'IMPF-3ms': 'VF3ms', 'IMPF-3fs': 'VF3fs', 'IMPF-3mp': 'VF3mp', 'IMPF-3fp': 'VF3fp',
+    'IMP-2ms': 'V!ms', 'IMP-2fs': 'V!fs', 'IMP-2mp': 'V!mp', 'IMP-2fp': 'V!fp'
+}
+
+noun_ids: Dict[str, str] = {
+    's': 'Nsa', 'p': 'Npa', 'sc': 'Nsc', 'pc': 'Npc'
+}
 
+adjective_ids: Dict[str, str] = {
+    'ms-a': 'Ams', 'fs-a': 'Afs', 'mp-a': 'Amp', 'fp-a': 'Afp'
+}
 
-def handle_noun(soup: BeautifulSoup, url: str) -> List[Card]:
-    return handle_id_list(soup, url, ids={
-        's': 'Nsa', 'p': 'Npa', 'sc': 'Nsc', 'pc': 'Npc'
-    })
 
+def handle_verb(soup: BeautifulSoup, url: str, *, extra_tags: str = '',
+                include_flags: Sequence[str] = (), exclude_flags: Sequence[str] = ()) -> List[Card]:
+    return handle_id_list(soup, url, ids=verb_ids, extra_tags=extra_tags,
+                          include_flags=include_flags, exclude_flags=exclude_flags)
 
-def handle_adjective(soup: BeautifulSoup, url: str) -> List[Card]:
-    return handle_id_list(soup, url, ids={
-        'ms-a': 'Ams', 'fs-a': 'Afs', 'mp-a': 'Amp', 'fp-a': 'Afp'
-    })
 
+def handle_noun(soup: BeautifulSoup, url: str, *, extra_tags: str = '',
+                include_flags: Sequence[str] = (), exclude_flags: Sequence[str] = ()) -> List[Card]:
+    return handle_id_list(soup, url, ids=noun_ids, extra_tags=extra_tags,
+                          include_flags=include_flags, exclude_flags=exclude_flags)
 
-def handle_adverb(soup: BeautifulSoup, url: str) -> List[Card]:
+
+def handle_adjective(soup: BeautifulSoup, url: str, *, extra_tags: str = '',
+                     include_flags: Sequence[str] = (), exclude_flags: Sequence[str] = ()) -> List[Card]:
+    return handle_id_list(soup, url, ids=adjective_ids, extra_tags=extra_tags,
+                          include_flags=include_flags, exclude_flags=exclude_flags)
+
+
+def handle_adverb(soup: BeautifulSoup, url: str, *, extra_tags: str = '',
+                  include_flags: Sequence[str] = (), exclude_flags: Sequence[str] = ()) -> List[Card]:
     cards: List[Card] = list()
+    include_masks = Card.precompile_filter(include_flags)
+    exclude_masks = Card.precompile_filter(exclude_flags)
+    if not Card.flags_pass('B', include_masks, exclude_masks):
+        return cards
     e_translation_headers: List[PageElement] = list()
     for text in ['Meaning', 'Перевод']:
-        e_translation_headers += soup.find_all('h3', string=text)
+        e_translation_headers.extend(soup.find_all('h3', string=text))
     for e_translation_header in e_translation_headers:
         e_translation = e_translation_header.next_sibling
         e_root = e_translation_header.parent
@@ -114,117 +190,246 @@ def handle_adverb(soup: BeautifulSoup, url: str) -> List[Card]:
         e_pronunciation = e_root.find(attrs={"class": "transcription"})
         n_found_elements = len([e for e in [e_word, e_translation, e_pronunciation] if e is not None])
         if n_found_elements > 1:
-            cards.append(Card(word=str(e_word).strip() if e_word is not None else '',
-                              translation=str(e_translation).strip() if e_translation is not None else '',
-                              pronunciation=str(e_pronunciation).strip() if e_pronunciation is not None else '',
-                              source=url, flags='B'))
+            cards.append(Card(word=element_text(e_word),
+                              translation=element_text(e_translation),
+                              pronunciation=element_html(e_pronunciation),
+                              source=url, flags='B', tags=extra_tags))
     return cards
 
 
-handler_map: List[Tuple[re.Pattern, Handler]] = [(re.compile(mask, flags=re.I), handler) for (mask, handler) in [
-    (r'^\s*Verb\s', handle_verb),
-    (r'^\s*Noun\s', handle_noun),
-    (r'^\s*Adjective\s', handle_adjective),
-    (r'^\s*Adverb\s', handle_adverb),
-    (r'^\s*Глагол\s', handle_verb),
-    (r'^\s*Существительное\s', handle_noun),
-    (r'^\s*Прилагательное\s', handle_adjective),
-    (r'^\s*Наречие\s', handle_adverb)
-]]
+handler_pattern = re.compile(r'^\s*(?:'
+                             r'(?P<verb>Verb|Глагол)|'
+                             r'(?P<noun>Noun|Существительное)|'
+                             r'(?P<adjective>Adjective|Прилагательное)|'
+                             r'(?P<adverb>Adverb|Наречие)'
+                             r')\s', flags=re.I)
+handler_map: Dict[str, Handler] = {
+    'verb': handle_verb,
+    'noun': handle_noun,
+    'adjective': handle_adjective,
+    'adverb': handle_adverb
+}
+
+# The description <meta> is read straight from the page bytes to pick the handler, so each page is parsed once.
+# Pages where it isn't found this way get a full parse and the description is read from the tree instead.
+description_pattern = re.compile(rb'<meta\s+name="description"\s+content="([^"]*)"', flags=re.I)
+
+
+def id_strainer(ids: Dict[str, str]) -> SoupStrainer:
+    # A set lookup per tag is much cheaper than letting bs4 match every tag against a list of IDs.
+    id_set = frozenset(ids.keys())
+    return SoupStrainer(id=id_set.__contains__)
+
+
+# Only the elements carrying the IDs of interest (and their contents) are built into the tree.
+# The adverb handler navigates from <h3> headers to their parents, so it needs the whole page.
+handler_strainers: Dict[Handler, Optional[SoupStrainer]] = {
+    handle_verb: id_strainer(verb_ids),
+    handle_noun: id_strainer(noun_ids),
+    handle_adjective: id_strainer(adjective_ids),
+    handle_adverb: None
+}
+
+
+@lru_cache(maxsize=1024)
+def get_handler_by_prefix(prefix: str) -> Optional[Handler]:
+    mo = handler_pattern.search(prefix)
+    if mo:
+        return handler_map.get(mo.lastgroup)
+    return None
 
 
 def get_handler_by_description(description: str) -> Optional[Handler]:
-    for (pattern, handler) in handler_map:
-        if pattern.search(description):
+    # Only the leading part-of-speech word matters, so short prefixes make a good cache key.
+    return get_handler_by_prefix(description[:32].lower())
+
+
+def find_handler(descriptions: Iterable[str], url: str) -> Optional[Handler]:
+    for description in descriptions:
+        handler = get_handler_by_description(description)
+        if handler is not None:
             return handler
+        print(f"No handler found for {url}")
     return None
 
 
 def process_url(session: Session, url: str, *,
-                additional_tags: str) -> List[Card]:
+                additional_tags: str,
+                include_flags: Sequence[str] = (),
+                exclude_flags: Sequence[str] = ()) -> List[Card]:
     try:
-        page = session.get(url)
+        page = session.get(url, timeout=REQUEST_TIMEOUT)
     except RequestException as e:
         print(f"Error reading {url}: {str(e)}")
         return list()
-    soup = BeautifulSoup(page.content, "html.parser")
-    descriptions = soup.find_all('meta', attrs={'name': 'description'})
+    descriptions = [html.unescape(mo.group(1).decode('utf_8', errors='replace'))
+                    for mo in description_pattern.finditer(page.content)]
     if len(descriptions) > 0:
-        for description in descriptions:
-            if 'content' in description.attrs:
-                handler = get_handler_by_description(description.attrs['content'])
-                if handler is not None:
-                    return [card.append_tags(additional_tags) for card in handler(soup, url)]
-                else:
-                    print(f"No handler found for {url}")
-    return list()
-
-
-def build_file_line_parser() -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser(prog='*', exit_on_error=False, add_help=False)
-    parser.add_argument('-i', '--include', dest='include_flags',
-                        default=list(), type=parse_flags)
-    parser.add_argument('-x', '--exclude', dest='exclude_flags',
-                        default=list(), type=parse_flags)
-    parser.add_argument('-t', '--tags', dest='tags',
-                        default=None, type=str)
-    return parser
+        handler = find_handler(descriptions, url)
+        if handler is None:
+            return list()
+        soup = BeautifulSoup(page.content, HTML_PARSER, parse_only=handler_strainers.get(handler))
+    else:
+        soup = BeautifulSoup(page.content, HTML_PARSER)
+        handler = find_handler((description.attrs['content']
+                                for description in soup.find_all('meta', attrs={'name': 'description'})
+                                if 'content' in description.attrs), url)
+        if handler is None:
+            return list()
+    return handler(soup, url, extra_tags=additional_tags,
+                   include_flags=include_flags, exclude_flags=exclude_flags)
+
+
+line_option_names: Dict[str, str] = {
+    '-i': 'include', '--include': 'include',
+    '-x': 'exclude', '--exclude': 'exclude',
+    '-t': 'tags', '--tags': 'tags'
+}
+
+
+def lookup_line_option(name: str) -> Optional[str]:
+    option = line_option_names.get(name)
+    if option is None and name.startswith('--') and len(name) > 2:
+        # Unambiguous prefixes of long options are accepted, as argparse does.
+        matches = {o for n, o in line_option_names.items() if n.startswith('--') and n.startswith(name)}
+        if len(matches) == 1:
+            option = matches.pop()
+    return option
+
+
+def parse_line_options(tokens: Sequence[str]) -> Tuple[List[str], List[str], Optional[str]]:
+    include_flags: List[str] = list()
+    exclude_flags: List[str] = list()
+    tags: Optional[str] = None
+    it = iter(tokens)
+    for token in it:
+        # Stray words are skipped, and everything after '--' is left alone, as parse_known_args() used to do.
+        if token == '--':
+            break
+        if not token.startswith('-') or token == '-':
+            continue
+        if token.startswith('--'):
+            name, has_value, value = token.partition('=')
+        else:
+            # Short options may have their value attached: -iVS or -i=VS
+            name, value = token[:2], token[2:]
+            has_value = len(value) > 0
+            if value.startswith('='):
+                value = value[1:]
+        option = lookup_line_option(name)
+        if option is None:
+            print(f"ignoring unrecognized option {name}")
+            continue
+        if not has_value:
+            value = next(it, None)
+            if value is None:
+                raise ValueError(f"{name}: expected one argument")
+        if option == 'include':
+            include_flags = parse_flags(value)
+        elif option == 'exclude':
+            exclude_flags = parse_flags(value)
+        else:
+            tags = value
+    return include_flags, exclude_flags, tags
+
+
+def is_cached(session: Session, url: str) -> bool:
+    cache = getattr(session, 'cache', None)
+    if cache is None:
+        return False
+    # contains() also counts expired entries, which the session will download again.
+    response = cache.get_response(cache.create_key(Request('GET', url)))
+    return response is not None and not response.is_expired
+
+
+class HostThrottle:
+    # Workers share one schedule per host, so requests to pealim start 1-5s apart as they did when read one by one.
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._next_start: Dict[str, float] = dict()
+
+    def wait(self, url: str) -> None:
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + randint(1, 5)
+        seconds = start - now
+        if seconds > 0:
+            print(f"sleeping {seconds:.0f}s before reading {url}")
+            sleep(seconds)
+
+
+def process_line(session: Session, throttle: HostThrottle, url: str, *, additional_tags: str,
+                 include_flags: List[str],
+                 exclude_flags: List[str]) -> List[Card]:
+    # Pages served from the local cache don't hit pealim, so there is no need to be polite.
+    if not is_cached(session, url):
+        throttle.wait(url)
+    cards = process_url(session, url, additional_tags=additional_tags,
+                        include_flags=include_flags, exclude_flags=exclude_flags)
+    print(f"{len(cards)} cards added from {url}")
+    return cards
 
 
 def process_file(in_file: Path, session: Session, *, additional_tags: str,
                  global_include_flags: List[str],
-                 global_exclude_flags: List[str]) -> List[Card]:
-    parser = build_file_line_parser()
-    all_cards: List[Card] = list()
-    with codecs.open(str(in_file), 'r', encoding='utf_8') as fh_in:
-        for line in fh_in:
-            try:
-                args = line.split()
-                if len(args) < 1:
-                    continue
-                url = args[0]
-                include_flags = copy(global_include_flags)
-                exclude_flags = copy(global_exclude_flags)
-                line_tags = ''
-                if len(args) > 1:
-                    parsed_options, _ = parser.parse_known_args(args=args[1:])
-                    include_flags += parsed_options.include_flags
-                    exclude_flags += parsed_options.exclude_flags
-                    line_tags = utils.cleanup(parsed_options.tags)
-                seconds = randint(1, 5)
-                print(f"sleeping {seconds}s before reading {url}")
-                sleep(seconds)
-                cards = process_url(session, url, additional_tags=(additional_tags + ' ' + line_tags))
-                print(f"{len(cards)} cards loaded from {url}")
-                cards_to_add: List[Card] = list()
-                for card in cards:
-                    if card.should_be_saved(include_flags=include_flags, exclude_flags=exclude_flags):
-                        cards_to_add.append(card)
-                print(f"{len(cards_to_add)} cards added")
-                all_cards += cards_to_add
-            except argparse.ArgumentError:
-                pass
+                 global_exclude_flags: List[str],
+                 workers: int) -> List[Card]:
+    futures: List[Future] = list()
+    throttle = HostThrottle()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with codecs.open(str(in_file), 'r', encoding='utf_8') as fh_in:
+            for line in fh_in:
+                try:
+                    args = line.split()
+                    if len(args) < 1:
+                        continue
+                    url = args[0]
+                    include_flags = copy(global_include_flags)
+                    exclude_flags = copy(global_exclude_flags)
+                    line_tags = ''
+                    if len(args) > 1:
+                        line_include_flags, line_exclude_flags, tags = parse_line_options(args[1:])
+                        include_flags.extend(line_include_flags)
+                        exclude_flags.extend(line_exclude_flags)
+                        line_tags = utils.cleanup(tags)
+                    futures.append(executor.submit(process_line, session, throttle, url,
+                                                   additional_tags=(additional_tags + ' ' + line_tags),
+                                                   include_flags=include_flags,
+                                                   exclude_flags=exclude_flags))
+                except ValueError as e:
+                    print(f"Skipping line {line.strip()}: {str(e)}")
+        # Collect in submission order, so the output follows the input file.
+        all_cards: List[Card] = list(chain.from_iterable(future.result() for future in futures))
     return all_cards
 
 
 def main() -> None:
     args = parse_cmdline_args()
 
-    session = Session()
+    if args.cache is not None and CachedSession is not None:
+        session = CachedSession(args.cache, expire_after=CACHE_EXPIRE_AFTER)
+    else:
+        session = Session()
+    adapter = HTTPAdapter(pool_maxsize=args.workers,
+                          max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
 
     print(f"reading URLs from {str(args.in_file)}")
     all_cards = process_file(args.in_file, session,
                              additional_tags=utils.cleanup(args.tags),
                              global_include_flags=args.include_flags,
-                             global_exclude_flags=args.exclude_flags)
+                             global_exclude_flags=args.exclude_flags,
+                             workers=args.workers)
     print(f"{len(all_cards)} total cards loaded")
 
     if len(all_cards) > 0:
         print(f"writing cards to {str(args.out_file)}")
-        with codecs.open(args.out_file, 'w', encoding='utf_8') as fh_out:
+        with open(args.out_file, 'w', encoding='utf_8', newline='', buffering=OUTPUT_BUFFER_SIZE) as fh_out:
             Card.save_header(fh_out)
-            for card in all_cards:
-                card.save(fh_out)
+            Card.save_many(all_cards, fh_out)
     else:
         print('No cards loaded, nothing to write!')
 
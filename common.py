@@ -1,17 +1,108 @@
 import unicodedata
-from typing import List, Optional, Sequence
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 import re
 from hashlib import sha256
-import codecs
+from functools import lru_cache
+from itertools import combinations
 import uuid
-from bs4 import BeautifulSoup
-
-
-class utils:
-
-    @staticmethod
-    def flags_help_text() -> str:
-        return '''
+import html
+import sys
+
+
+# A str.translate() table deleting characters outside the given Unicode major categories.
+# It is filled in lazily, so it only ever holds characters actually seen.
+class _CategoryFilter(dict):
+
+    def __init__(self, categories: str):
+        super().__init__()
+        self._categories = categories
+
+    def __missing__(self, code_point: int) -> Optional[int]:
+        value = code_point if unicodedata.category(chr(code_point))[0] in self._categories else None
+        self[code_point] = value
+        return value
+
+
+_LETTERS_ONLY = _CategoryFilter('L')
+_LETTERS_AND_MARKS = _CategoryFilter('LM')
+_TAG_RE = re.compile(r'<[^>]+>')
+_STRESS_RE = re.compile(r'([^*]*)\*([^*]+)\*([^*]*)\Z')
+
+_ASK_PRONUNCIATION = "<em style=\"font-size:14pt\">Pronounce:</em><br /><br />"
+_ASK_TRANSLATION = "<em style=\"font-size:14pt\">Translate:</em><br /><br />"
+_ASK_SPELLING = "<em style=\"font-size:14pt\">Spell:</em><br /><br />"
+
+_WORD_SPAN = "<span style=\"font-size:24pt;\">"
+_MASCULINE_WORD_SPAN = "<span style=\"font-size:24pt;color:blue;\">"
+_FEMININE_WORD_SPAN = "<span style=\"font-size:24pt;color:red;\">"
+
+
+# Flag strings are folded into an int with one bit per character, so flag tests become bitwise operations.
+def _flag_mask(flags: str) -> int:
+    mask = 0
+    for c in flags:
+        mask |= 1 << ord(c)
+    return mask
+
+
+_MASCULINE = _flag_mask('m')
+_FEMININE = _flag_mask('f')
+_SINGLE = _flag_mask('s')
+_PLURAL = _flag_mask('p')
+_FIRST = _flag_mask('1')
+_SECOND = _flag_mask('2')
+_THIRD = _flag_mask('3')
+_INFINITIVE = _flag_mask('I')
+_PRESENT = _flag_mask('P')
+_PAST = _flag_mask('S')
+_FUTURE = _flag_mask('F')
+_ABSOLUTE = _flag_mask('a')
+_CONSTRUCT = _flag_mask('c')
+_ANNOTATED = _flag_mask('mfsp123IPSFac')
+
+
+# Maps every combination of the given flags to the label of the first one present.
+def _first_present_labels(labels: Sequence[Tuple[int, str]]) -> Dict[int, str]:
+    table: Dict[int, str] = dict()
+    for n in range(1, len(labels) + 1):
+        for combination in combinations(labels, n):
+            table[sum(mask for mask, _ in combination)] = combination[0][1]
+    return table
+
+
+# One (selector, labels) pair per annotated category; combinations missing from a table get no annotation.
+_ANNOTATION_TABLES: List[Tuple[int, Dict[int, str]]] = [
+    # gender
+    (_MASCULINE | _FEMININE, {_MASCULINE: 'masculine', _FEMININE: 'feminine'}),
+    # person
+    (_FIRST | _SECOND | _THIRD, {
+        _FIRST: '1st person', _SECOND: '2nd person', _THIRD: '3rd person',
+        _FIRST | _SECOND: '1st/2nd person', _FIRST | _THIRD: '1st/3rd person', _SECOND | _THIRD: '2nd/3rd person'
+    }),
+    # number
+    (_SINGLE | _PLURAL, {_SINGLE: 'single', _PLURAL: 'plural'}),
+    # tense
+    (_INFINITIVE | _PRESENT | _PAST | _FUTURE, _first_present_labels([
+        (_INFINITIVE, 'infinitive'), (_PRESENT, 'present'), (_PAST, 'past'), (_FUTURE, 'future')
+    ])),
+    # absolute vs construct
+    (_ABSOLUTE | _CONSTRUCT, {_ABSOLUTE: 'absolute', _CONSTRUCT: 'construct'})
+]
+
+
+# Callers pass the mask reduced to _ANNOTATED, which doesn't depend on flag order, repetition
+# or unrelated flags, so a deck only ever hits a few dozen distinct keys.
+@lru_cache(maxsize=1024)
+def _annotate_flag_mask(mask: int) -> str:
+    annotations: List[str] = []
+    for selector, labels in _ANNOTATION_TABLES:
+        label = labels.get(mask & selector)
+        if label is not None:
+            annotations.append(label)
+    return ' '.join(annotations)
+
+
+FLAGS_HELP_TEXT = '''
 Available flags
 ---------------
 
@@ -24,146 +115,139 @@ Available flags
 [Special handling during manual import] . (dot) - don't remove nekudot
         '''
 
-    @staticmethod
-    def annotate_flags(flags: str) -> str:
-        annotations: List[str] = []
-        # gender
-        if 'm' in flags and 'f' in flags:
-            pass
-        elif 'm' in flags:
-            annotations.append('masculine')
-        elif 'f' in flags:
-            annotations.append('feminine')
-        # person
-        if '1' in flags and '2' in flags and '3' in flags:
-            pass
-        elif '1' in flags and '2' in flags:
-            annotations.append('1st/2nd person')
-        elif '1' in flags and '3' in flags:
-            annotations.append('1st/3rd person')
-        elif '2' in flags and '3' in flags:
-            annotations.append('2nd/3rd person')
-        elif '1' in flags:
-            annotations.append('1st person')
-        elif '2' in flags:
-            annotations.append('2nd person')
-        elif '3' in flags:
-            annotations.append('3rd person')
-        # number
-        if 's' in flags and 'p' in flags:
-            pass
-        elif 's' in flags:
-            annotations.append('single')
-        elif 'p' in flags:
-            annotations.append('plural')
-        # tense
-        if 'I' in flags:
-            annotations.append('infinitive')
-        elif 'P' in flags:
-            annotations.append('present')
-        elif 'S' in flags:
-            annotations.append('past')
-        elif 'F' in flags:
-            annotations.append('future')
-        # absolute vs construct
-        if 'a' in flags and 'c' in flags:
-            pass
-        elif 'a' in flags:
-            annotations.append('absolute')
-        elif 'c' in flags:
-            annotations.append('construct')
-        # put all together
-        if len(annotations) > 0:
-            return ' '.join(annotations)
-        else:
-            return ''
 
-    @staticmethod
-    def cleanup(s: Optional[str]) -> str:
-        if s is not None:
-            return s.replace('\t', ' ').strip()
-        else:
-            return ''
+def flags_help_text() -> str:
+    return FLAGS_HELP_TEXT
 
-    @staticmethod
-    def remove_html(content: str) -> str:
-        soup = BeautifulSoup(content, "html.parser")
-        return utils.cleanup(str(soup.string))
 
-    @staticmethod
-    def remove_nekudot(word: Optional[str], flags: Optional[str] = None) -> str:
-        word = utils.remove_html(word)
-        # Start by leaving only letters and markings
-        word = ''.join([c for c in word if unicodedata.category(c)[0] in ['L', 'M']])
-        if flags is not None:
-            # If flags explicitly require leaving nekudot in place, do nothing.
-            if '.' not in flags:
-                naked_word = ''.join([c for c in word if unicodedata.category(c)[0] == 'L'])
-                # Now a very Hebrew-specific stuff. For 2nd person past tense verbs,
-                # leave the very last marking in place.
-                if '2' in flags and 'V' in flags and 'S' in flags:
-                    if len(word) > 0:
-                        last_char = word[-1]
-                        if unicodedata.category(last_char)[0] == 'M':
-                            word = naked_word + last_char
-                        else:
-                            word = naked_word
-                # Otherwise, leave only the letters.
-                else:
-                    word = naked_word
-        return word
+def annotate_flags(flags: Union[str, int]) -> str:
+    mask = flags if isinstance(flags, int) else _flag_mask(flags)
+    return _annotate_flag_mask(mask & _ANNOTATED)
 
-    @staticmethod
-    def dress_word(word: Optional[str], flags: str) -> str:
-        word = utils.remove_nekudot(word, flags)
-        if len(word) == 0:
-            return word
-        style = 'font-size:24pt;'
-        if 'm' in flags:
-            style += 'color:blue;'
-        elif 'f' in flags:
-            style += 'color:red;'
-        return f"<span style=\"{style}\">{word}</span>"
 
-    @staticmethod
-    def dress_translation(translation: Optional[str], flags: str) -> str:
-        translation = utils.cleanup(translation)
-        if len(translation) == 0:
-            return translation
-        text = f"<span style=\"font-size:18pt;\">{translation}</span>"
-        annotation = utils.annotate_flags(flags)
-        if len(annotation) > 0:
-            text += f"<span style=\"font-size:12pt;\"><br />({annotation})</span>"
-        return text
-
-    # noinspection PyUnusedLocal
-    @staticmethod
-    def dress_pronunciation(pronunciation: Optional[str], flags: str) -> str:
-        # replace all commas, so we don't bother about comma-separated CSV
-        pronunciation = utils.cleanup(pronunciation)
-        if len(pronunciation) == 0:
-            return pronunciation
-        mo = re.search(r'^([^*]*)\*([^*]+)\*([^*]*)$', pronunciation)
-        if mo:
-            return (f"<span style=\"font-size:18pt\">{mo[1]}<span style=\"color:red;font-weight:bold;\">{mo[2]}" +
-                    f"</span>{mo[3]}</span>")
-        else:
-            return f"<span style=\"font-size:18pt\">{pronunciation}</span>"
+def cleanup(s: Optional[str]) -> str:
+    if s is not None:
+        return s.replace('\t', ' ').strip()
+    else:
+        return ''
+
+
+def remove_html(content: Optional[str]) -> str:
+    if content is None:
+        return ''
+    # Most words are plain text already.
+    if '<' not in content and '&' not in content:
+        return cleanup(content)
+    return cleanup(html.unescape(_TAG_RE.sub('', content)))
+
+
+def remove_nekudot(word: Optional[str], flags: Optional[str] = None, is_plain: bool = False) -> str:
+    if not is_plain:
+        word = remove_html(word)
+    # str.isalpha() is true only for letter categories, so such words have neither
+    # punctuation to drop nor nekudot to strip.
+    if word.isalpha():
+        return word
+    # Start by leaving only letters and markings
+    word = word.translate(_LETTERS_AND_MARKS)
+    if flags is not None:
+        # If flags explicitly require leaving nekudot in place, do nothing.
+        if '.' not in flags:
+            naked_word = word.translate(_LETTERS_ONLY)
+            # Now a very Hebrew-specific stuff. For 2nd person past tense verbs,
+            # leave the very last marking in place.
+            if '2' in flags and 'V' in flags and 'S' in flags:
+                if len(word) > 0:
+                    last_char = word[-1]
+                    if unicodedata.category(last_char)[0] == 'M':
+                        word = naked_word + last_char
+                    else:
+                        word = naked_word
+            # Otherwise, leave only the letters.
+            else:
+                word = naked_word
+    return word
+
+
+def dress_word(word: Optional[str], flags: str, is_plain: bool = False) -> str:
+    word = remove_nekudot(word, flags, is_plain=is_plain)
+    if len(word) == 0:
+        return word
+    if 'm' in flags:
+        return _MASCULINE_WORD_SPAN + word + '</span>'
+    elif 'f' in flags:
+        return _FEMININE_WORD_SPAN + word + '</span>'
+    else:
+        return _WORD_SPAN + word + '</span>'
+
+
+def dress_translation(translation: Optional[str], flags: Union[str, int], is_clean: bool = False) -> str:
+    if not is_clean:
+        translation = cleanup(translation)
+    if len(translation) == 0:
+        return translation
+    text = f"<span style=\"font-size:18pt;\">{translation}</span>"
+    annotation = annotate_flags(flags)
+    if len(annotation) > 0:
+        text += f"<span style=\"font-size:12pt;\"><br />({annotation})</span>"
+    return text
+
+
+# noinspection PyUnusedLocal
+def dress_pronunciation(pronunciation: Optional[str], flags: str, is_clean: bool = False) -> str:
+    # replace all commas, so we don't bother about comma-separated CSV
+    if not is_clean:
+        pronunciation = cleanup(pronunciation)
+    if len(pronunciation) == 0:
+        return pronunciation
+    mo = _STRESS_RE.match(pronunciation) if '*' in pronunciation else None
+    if mo:
+        return (f"<span style=\"font-size:18pt\">{mo[1]}<span style=\"color:red;font-weight:bold;\">{mo[2]}" +
+                f"</span>{mo[3]}</span>")
+    else:
+        return f"<span style=\"font-size:18pt\">{pronunciation}</span>"
+
+
+# Kept so that `from common import utils` and `utils.cleanup(...)` callers keep working.
+utils = sys.modules[__name__]
+
+
+# The '.' flag keeps remove_nekudot from touching the marks, so the stem only depends on the word and the source.
+# The word must have had its HTML removed already.
+# An empty result means there is nothing to hash, and the caller falls back to a random UUID.
+@lru_cache(maxsize=8192)
+def _hashed_uuid_stem(plain_word: str, source: str) -> str:
+    rep = remove_nekudot(plain_word, '.', is_plain=True)
+    if len(rep) == 0 and len(source) == 0:
+        return ''
+    # Same digest as hashing rep + '|' + source, without building the joined string.
+    digest = sha256(rep.encode('utf-8'))
+    if len(source) > 0:
+        digest.update(b'|')
+        digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
 
 
 class Card:
 
+    __slots__ = ('_word', '_plain_word', '_translation', '_pronunciation', '_flags', '_flag_mask',
+                 '_tags', '_source', '_uuid_prefix', '_uuid_stem')
+
     def __init__(self, *,
                  word: Optional[str], translation: Optional[str], pronunciation: Optional[str],
                  flags: Optional[str] = None, tags: Optional[str] = None, source: Optional[str] = None,
                  uuid_prefix: str = 'PGMS'):
-        self._word = utils.cleanup(word)
-        self._translation = utils.cleanup(translation)
-        self._pronunciation = utils.cleanup(pronunciation)
-        self._flags = utils.cleanup(flags)
-        self._tags = utils.cleanup(tags)
-        self._source = utils.cleanup(source)
+        self._word = cleanup(word)
+        # Both the UUID stem and the dressed word need the word without HTML.
+        self._plain_word = remove_html(self._word)
+        self._translation = cleanup(translation)
+        self._pronunciation = cleanup(pronunciation)
+        self._flags = cleanup(flags)
+        self._flag_mask = _flag_mask(self._flags)
+        self._tags = cleanup(tags)
+        self._source = cleanup(source)
         self._uuid_prefix = uuid_prefix
+        self._uuid_stem: Optional[str] = None
 
     @property
     def word(self) -> str:
@@ -186,99 +270,118 @@ class Card:
         return self._tags
 
     def append_tags(self, tags: str) -> "Card":
-        self._tags += ' ' + utils.cleanup(tags)
+        self._tags += ' ' + cleanup(tags)
         return self
 
     def append_flags(self, flags: str) -> "Card":
-        self._flags += ' ' + utils.cleanup(flags)
+        flags = ' ' + cleanup(flags)
+        self._flags += flags
+        self._flag_mask |= _flag_mask(flags)
         return self
 
-    def has_all_flags(self, flags: str) -> bool:
-        flags = utils.cleanup(flags)
-        if len(flags) < 1:
-            return False
-        for c in flags:
-            if c not in self._flags:
-                return False
-        return True
-
-    def has_some_flags(self, flags: str) -> bool:
-        flags = utils.cleanup(flags)
-        if len(flags) < 1:
-            return False
-        for c in flags:
-            if c in self._flags:
-                return True
-        return False
+    @staticmethod
+    def precompile_filter(flags: Sequence[str]) -> List[int]:
+        # Flag strings that are empty after cleanup give 0, which never matches.
+        return [_flag_mask(cleanup(f)) for f in flags]
 
-    def has_flags(self, flags: Sequence[str]) -> bool:
-        if len(flags) < 1:
-            return False
-        for f in flags:
-            if self.has_all_flags(f):
+    # True if own_mask has every flag of at least one of the masks.
+    @staticmethod
+    def mask_matches_any(own_mask: int, masks: Sequence[int]) -> bool:
+        for mask in masks:
+            if mask != 0 and own_mask & mask == mask:
                 return True
         return False
 
-    def should_be_saved(self, include_flags: Sequence[str], exclude_flags: Sequence[str]) -> bool:
-        include_given = len(include_flags) > 0
-        exclude_given = len(exclude_flags) > 0
+    @staticmethod
+    def _mask_passes(own_mask: int, include_masks: Sequence[int], exclude_masks: Sequence[int]) -> bool:
+        include_given = len(include_masks) > 0
+        exclude_given = len(exclude_masks) > 0
         # No restrictions
         if not include_given and not exclude_given:
             return True
         # If only inclusion is specified, only save this card if it has any included flags.
         elif include_given and not exclude_given:
-            return self.has_flags(include_flags)
+            return Card.mask_matches_any(own_mask, include_masks)
         # If only exclusion is specified, save this card unless it has any excluded flags.
         elif not include_given and exclude_given:
-            return not self.has_flags(exclude_flags)
+            return not Card.mask_matches_any(own_mask, exclude_masks)
         # Both inclusion and exclusion is specified. Inclusion has priority.
-        elif self.has_flags(include_flags):
+        elif Card.mask_matches_any(own_mask, include_masks):
             return True
         else:
-            return not self.has_flags(exclude_flags)
+            return not Card.mask_matches_any(own_mask, exclude_masks)
+
+    # Same test as should_be_saved_masked(), for flags of a card that hasn't been built yet.
+    @staticmethod
+    def flags_pass(flags: str, include_masks: Sequence[int], exclude_masks: Sequence[int]) -> bool:
+        return Card._mask_passes(_flag_mask(cleanup(flags)), include_masks, exclude_masks)
+
+    def has_all_flags(self, flags: str) -> bool:
+        mask = _flag_mask(cleanup(flags))
+        return mask != 0 and self._flag_mask & mask == mask
+
+    def has_some_flags(self, flags: str) -> bool:
+        return self._flag_mask & _flag_mask(cleanup(flags)) != 0
+
+    def has_flags(self, flags: Sequence[str]) -> bool:
+        return self.has_flags_mask(Card.precompile_filter(flags))
+
+    def has_flags_mask(self, masks: Sequence[int]) -> bool:
+        return Card.mask_matches_any(self._flag_mask, masks)
+
+    # When filtering many cards, build the masks once with precompile_filter() and use should_be_saved_masked().
+    def should_be_saved(self, include_flags: Sequence[str], exclude_flags: Sequence[str]) -> bool:
+        return self.should_be_saved_masked(Card.precompile_filter(include_flags), Card.precompile_filter(exclude_flags))
+
+    def should_be_saved_masked(self, include_masks: Sequence[int], exclude_masks: Sequence[int]) -> bool:
+        return Card._mask_passes(self._flag_mask, include_masks, exclude_masks)
 
     def calc_uuid_stem(self) -> str:
-        rep = utils.remove_nekudot(self._word, self._flags + '.')
-        if len(self._source) > 0:
-            rep += '|' + self._source
-        if len(rep) > 0:
-            return sha256(codecs.encode(rep, encoding='utf-8')).hexdigest()
-        else:
-            return uuid.uuid1().hex
+        if self._uuid_stem is None:
+            self._uuid_stem = _hashed_uuid_stem(self._plain_word, self._source) or uuid.uuid1().hex
+        return self._uuid_stem
 
     @staticmethod
     def save_header(fh) -> None:
         fh.write("#html:true\n#separator:tab\n#columns:UUID\tFront\tBack\tTags\n#tags column:4\n")
 
     def save(self, fh) -> None:
-        dressed_word = utils.dress_word(self._word, self._flags)
-        dressed_translation = utils.dress_translation(self._translation, self._flags)
-        dressed_pronunciation = utils.dress_pronunciation(self._pronunciation, self._flags)
-        ask_pronunciation = "<em style=\"font-size:14pt\">Pronounce:</em>"
-        ask_translation = "<em style=\"font-size:14pt\">Translate:</em>"
-        ask_spelling = "<em style=\"font-size:14pt\">Spell:</em>"
+        fh.write(self.to_rows())
 
-        non_empty_count = len([w for w in [dressed_word, dressed_translation, dressed_pronunciation] if len(w) > 0])
-        if non_empty_count == 0:
-            return
+    @staticmethod
+    def save_many(cards: Iterable["Card"], fh, batch_size: int = 1000) -> int:
+        batch: List[str] = []
+        n_cards = 0
+        for card in cards:
+            batch.append(card.to_rows())
+            n_cards += 1
+            if len(batch) >= batch_size:
+                fh.write(''.join(batch))
+                batch.clear()
+        fh.write(''.join(batch))
+        return n_cards
+
+    def to_rows(self) -> str:
+        # The fields were cleaned up in __init__ already.
+        dressed_word = dress_word(self._plain_word, self._flags, is_plain=True)
+        dressed_translation = dress_translation(self._translation, self._flag_mask, is_clean=True)
+        dressed_pronunciation = dress_pronunciation(self._pronunciation, self._flags, is_clean=True)
+
+        if len(dressed_word) == 0 and len(dressed_translation) == 0 and len(dressed_pronunciation) == 0:
+            return ''
 
+        prefix = self._uuid_prefix
         uuid_stem = self.calc_uuid_stem()
+        tail = '\t' + self._tags + '\n'
 
+        rows: List[str] = []
         if len(dressed_word) > 0 and len(dressed_translation) > 0:
-            fh.write(f"{self._uuid_prefix}WT{uuid_stem}\t" +
-                     f"{ask_translation}<br /><br />{dressed_word}\t" +
-                     f"{ask_translation}<br /><br />{dressed_translation}\t" +
-                     self._tags + '\n')
+            rows.append(f"{prefix}WT{uuid_stem}\t{_ASK_TRANSLATION}{dressed_word}\t"
+                        f"{_ASK_TRANSLATION}{dressed_translation}{tail}")
         if len(dressed_word) > 0 and len(dressed_pronunciation) > 0:
-            fh.write(f"{self._uuid_prefix}WP{uuid_stem}\t" +
-                     f"{ask_pronunciation}<br /><br />{dressed_word}\t" +
-                     f"{ask_spelling}<br /><br />{dressed_pronunciation}\t" +
-                     self._tags + '\n')
+            rows.append(f"{prefix}WP{uuid_stem}\t{_ASK_PRONUNCIATION}{dressed_word}\t"
+                        f"{_ASK_SPELLING}{dressed_pronunciation}{tail}")
         if len(dressed_pronunciation) > 0 and len(dressed_translation) > 0:
-            fh.write(f"{self._uuid_prefix}PT{uuid_stem}\t" +
-                     f"{ask_translation}<br /><br />{dressed_pronunciation}\t" +
-                     f"{ask_pronunciation}<br /><br />{dressed_translation}\t" +
-                     self._tags + '\n')
-
-
-
+            rows.append(f"{prefix}PT{uuid_stem}\t{_ASK_TRANSLATION}{dressed_pronunciation}\t"
+                        f"{_ASK_PRONUNCIATION}{dressed_translation}{tail}")
+        return ''.join(rows)